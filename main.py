@@ -1,23 +1,44 @@
 import asyncio
+import io
 import os
-import tempfile
-import uuid
 import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Dict
+from typing import Optional, Tuple
 
+import orjson
 from aiohttp import web
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+
+try:
+    import av
+except ImportError:  # PyAV не собрался/не установлен — работаем через subprocess
+    av = None
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     Message,
-    FSInputFile,
+    BufferedInputFile,
     CallbackQuery,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
+# Свои временные файлы бот больше не пишет, но tempfile.gettempdir() ещё
+# используется (уборка сирот) и доступен сторонним библиотекам. Если есть
+# tmpfs /dev/shm — направляем всё временное в RAM, а не на эфемерный диск.
+if os.access("/dev/shm", os.W_OK):
+    os.environ.setdefault("TMPDIR", "/dev/shm")
+    tempfile.tempdir = None  # сбросить закэшированный gettempdir()
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("Не задан BOT_TOKEN в переменных окружения")
@@ -37,22 +58,99 @@ BASE_WEBHOOK_URL = BASE_WEBHOOK_URL.rstrip("/")
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}"
 
-bot = Bot(token=BOT_TOKEN)
+# Одна aiohttp-сессия с большим пулом keep-alive соединений до api.telegram.org:
+# TCP/TLS переиспользуются между запросами, и параллельные отправки не упираются
+# в дефолтный лимит коннектора. JSON гоняем через orjson — он в разы быстрее
+# stdlib, а через session.json_loads его подхватывает и разбор апдейтов вебхука.
+session = AiohttpSession(
+    json_loads=orjson.loads,
+    json_dumps=lambda value: orjson.dumps(value).decode(),
+)
+session._connector_init.update(
+    limit=100,
+    limit_per_host=100,
+    keepalive_timeout=75,
+    ttl_dns_cache=300,
+)
+
+bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher()
 
 # ---------------- НАСТРОЙКИ ПОЛЬЗОВАТЕЛЯ ----------------
 
-# Формат кадра: "png" | "jpg" | "webp"
-user_format_prefs: Dict[int, str] = {}
-# Размер: "orig" | "1024" | "1024sq"
-user_size_prefs: Dict[int, str] = {}
-# Последний файл видео пользователя (file_id)
-user_last_file_id: Dict[int, str] = {}
+
+@dataclass(slots=True)
+class UserState:
+    """Настройки и последнее видео одного пользователя."""
+
+    # Формат кадра: "png" | "jpg" | "webp"
+    fmt: str = "png"
+    # Размер: "orig" | "1024" | "1024sq"
+    size: str = "orig"
+    # file_id последнего присланного видео
+    last_file_id: Optional[str] = None
+
+
+# Состояние пользователей живёт сутки и ограничено по числу записей:
+# обычные dict'ы на вебхуке растут бесконечно по мере прихода новых людей.
+user_state: "TTLCache[int, UserState]" = TTLCache(maxsize=50_000, ttl=86_400)
+
+
+def get_state(user_id: int) -> UserState:
+    state = user_state.get(user_id)
+    if state is None:
+        state = UserState()
+        user_state[user_id] = state
+    return state
+
+# Кэш готовых кадров: (file_id видео, формат, размер) -> file_id фото в Telegram.
+# Повторный запрос с теми же настройками — это один дешёвый sendPhoto по
+# file_id, без скачивания видео и без запуска ffmpeg.
+FRAME_CACHE_MAX = 256
+frame_cache: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+
+
+def cache_frame(key: Tuple[str, str, str], photo_file_id: str) -> None:
+    """Запоминаем file_id загруженного кадра, вытесняя самые старые записи."""
+    frame_cache[key] = photo_file_id
+    frame_cache.move_to_end(key)
+    while len(frame_cache) > FRAME_CACHE_MAX:
+        frame_cache.popitem(last=False)
+
+
+def get_cached_frame(key: Tuple[str, str, str]) -> str | None:
+    photo_file_id = frame_cache.get(key)
+    if photo_file_id is not None:
+        frame_cache.move_to_end(key)
+    return photo_file_id
+
+
+# Сильные ссылки на фоновые задачи: без них asyncio.Task может быть собран GC
+# до завершения (предупреждение из документации asyncio).
+background_tasks: set = set()
+
+
+def _background_done(task: "asyncio.Task") -> None:
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Фоновая задача упала: {task.exception()}", flush=True)
+
+
+def spawn_background(awaitable) -> "asyncio.Future":
+    """
+    Запускает awaitable фоном, не задерживая обработку текущего апдейта.
+    ensure_future, а не create_task: методы aiogram вроде chat.do() возвращают
+    TelegramMethod — awaitable, но не корутину, create_task его не примет.
+    """
+    task = asyncio.ensure_future(awaitable)
+    background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
 
 
 def get_user_format(user_id: int) -> str:
     """Формат по умолчанию — PNG, если пользователь ничего не выбирал."""
-    return user_format_prefs.get(user_id, "png")
+    return get_state(user_id).fmt
 
 
 def set_user_format(user_id: int, fmt: str) -> None:
@@ -62,19 +160,19 @@ def set_user_format(user_id: int, fmt: str) -> None:
         fmt = "jpg"
     if fmt not in ("png", "jpg", "webp"):
         fmt = "png"
-    user_format_prefs[user_id] = fmt
+    get_state(user_id).fmt = fmt
 
 
 def get_user_size(user_id: int) -> str:
     """Размер по умолчанию — оригинальный."""
-    return user_size_prefs.get(user_id, "orig")
+    return get_state(user_id).size
 
 
 def set_user_size(user_id: int, size: str) -> None:
     size = size.lower()
     if size not in ("orig", "1024", "1024sq"):
         size = "orig"
-    user_size_prefs[user_id] = size
+    get_state(user_id).size = size
 
 
 def describe_size(size_mode: str) -> str:
@@ -86,7 +184,7 @@ def describe_size(size_mode: str) -> str:
     return "оригинальное разрешение"
 
 
-def build_settings_keyboard(user_id: int):
+def _build_settings_markup(current_fmt: str, current_size: str):
     """
     Инлайн-клавиатура под ответом:
     [ PNG ] [ JPG ] [ WEBP ]
@@ -94,9 +192,6 @@ def build_settings_keyboard(user_id: int):
     [ 🔁 Перегенерировать ]
     Текущие настройки помечаем ✅
     """
-    current_fmt = get_user_format(user_id)
-    current_size = get_user_size(user_id)
-
     kb = InlineKeyboardBuilder()
 
     # Форматы
@@ -128,20 +223,186 @@ def build_settings_keyboard(user_id: int):
     return kb.as_markup()
 
 
+# Всего 3×3 различных состояний клавиатуры — собираем их один раз при импорте,
+# дальше каждая отдача клавиатуры — это поиск в словаре, а не пересборка.
+_KB_CACHE = {
+    (fmt, size): _build_settings_markup(fmt, size)
+    for fmt in ("png", "jpg", "webp")
+    for size in ("orig", "1024", "1024sq")
+}
+
+
+def build_settings_keyboard(user_id: int):
+    """Возвращает готовую клавиатуру под текущие настройки пользователя."""
+    return _KB_CACHE[(get_user_format(user_id), get_user_size(user_id))]
+
+
+# ---------------- ОЧЕРЕДЬ ОТПРАВКИ В TELEGRAM ----------------
+
+# Общий лимит Telegram — 30 сообщений/с на бота. Все отправки идут через одну
+# очередь с token bucket на 29/с: бурст кнопок растягивается в ровный поток
+# вместо каскада 429-ретраев.
+SEND_WORKERS = 4
+send_limiter = AsyncLimiter(29, 1)
+send_queue: "asyncio.Queue[tuple]" = asyncio.Queue()
+
+
+async def send_limited(fn, /, *args, **kwargs):
+    """Ставит API-вызов в общую очередь отправки и возвращает его результат."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    await send_queue.put((partial(fn, *args, **kwargs), fut))
+    return await fut
+
+
+async def _send_worker() -> None:
+    """Разгребает очередь отправки, не превышая лимит Telegram."""
+    while True:
+        fn, fut = await send_queue.get()
+        try:
+            async with send_limiter:
+                result = await fn()
+        except Exception as e:
+            if not fut.cancelled():
+                fut.set_exception(e)
+        else:
+            if not fut.cancelled():
+                fut.set_result(result)
+        finally:
+            send_queue.task_done()
+
+
 # ---------------- ОБРАБОТКА ВИДЕО ----------------
 
+# Извлечение кадра уходит в пул отдельных процессов: воркеров ровно по числу
+# ядер — больше только добавило бы планировщику ОС работы, — а event loop
+# основного процесса не трогает ни GIL во время декода, ни child watcher.
+extract_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 2)
+
+# Пул переиспользуемых буферов для скачивания. Буфер занят от начала
+# скачивания до конца извлечения кадра, поэтому очередь служит back-pressure
+# на весь конвейер: больше DOWNLOAD_BUFFERS видео в обработке (скачиваемых или
+# ждущих воркера extract_pool) не окажется, остальные запросы ждут свободный
+# буфер вместо того, чтобы раздувать RSS.
+DOWNLOAD_BUFFERS = 8
+buf_pool: "asyncio.Queue[io.BytesIO]" = asyncio.Queue()
+for _ in range(DOWNLOAD_BUFFERS):
+    buf_pool.put_nowait(io.BytesIO())
+
+
+async def fetch_and_extract(
+    file_id: str, output_format: str, size_mode: str
+) -> bytes:
+    """
+    Скачивает видео по file_id и вырезает из него последний кадр.
+    Единственный путь обработки — и для свежих сообщений, и для перегенерации.
+    """
+    buf = await buf_pool.get()
+    try:
+        await bot.download(file_id, destination=buf)
+        return await extract_last_frame(
+            buf.getvalue(),
+            output_format=output_format,
+            size_mode=size_mode,
+        )
+    finally:
+        buf.seek(0)
+        buf.truncate(0)
+        buf_pool.put_nowait(buf)
+
+
+# Муксер / кодек / pix_fmt для каждого формата кадра в PyAV
+_AV_OUTPUT = {
+    "png": ("image2pipe", "png", "rgb24"),
+    "jpg": ("mjpeg", "mjpeg", "yuvj420p"),
+    "webp": ("webp", "libwebp", "yuv420p"),
+}
+
+
+def _apply_size_filters(frame: "av.VideoFrame", size_mode: str) -> "av.VideoFrame":
+    """Прогоняет кадр через те же scale/crop фильтры, что и команда ffmpeg."""
+    if size_mode == "1024":
+        filters = [("scale", "'if(gt(iw,ih),1024,-2)':'if(gt(ih,iw),1024,-2)'")]
+    elif size_mode == "1024sq":
+        filters = [
+            ("scale", "1024:1024:force_original_aspect_ratio=increase"),
+            ("crop", "1024:1024"),
+        ]
+    else:
+        return frame
+
+    graph = av.filter.Graph()
+    nodes = [graph.add_buffer(template=frame)]
+    for name, args in filters:
+        nodes.append(graph.add(name, args))
+    nodes.append(graph.add("buffersink"))
+    graph.link_nodes(*nodes).configure()
+    graph.push(frame)
+    return graph.pull()
+
+
+def _extract_frame_av(
+    video: bytes, output_format: str, size_mode: str, timeout_sec: int
+) -> bytes:
+    """
+    Достаёт последний кадр через PyAV в текущем процессе: без fork+exec,
+    без инициализации ffmpeg-бинаря на каждый запрос.
+    """
+    deadline = time.monotonic() + timeout_sec
+
+    with av.open(io.BytesIO(video)) as container:
+        stream = container.streams.video[0]
+
+        # Прыгаем к ключевому кадру около конца и декодируем остаток —
+        # аналог -sseof -0.1
+        if stream.duration is not None and stream.time_base:
+            offset = int(0.1 / stream.time_base)
+            container.seek(max(stream.duration - offset, 0), stream=stream)
+        elif container.duration is not None:
+            container.seek(max(container.duration - 100_000, 0))
+
+        last_frame = None
+        for frame in container.decode(stream):
+            last_frame = frame
+            # Битое видео (или неудачный seek) может означать декод почти
+            # всего файла — не даём воркеру зависнуть навсегда
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Декод не уложился в {timeout_sec} сек")
+
+    if last_frame is None:
+        raise RuntimeError("Не удалось декодировать ни одного кадра из видео")
+
+    last_frame = _apply_size_filters(last_frame, size_mode)
+
+    muxer, codec, pix_fmt = _AV_OUTPUT[output_format]
+    last_frame = last_frame.reformat(format=pix_fmt)
+
+    out_buf = io.BytesIO()
+    with av.open(out_buf, "w", format=muxer) as out:
+        out_stream = out.add_stream(codec)
+        out_stream.width = last_frame.width
+        out_stream.height = last_frame.height
+        out_stream.pix_fmt = pix_fmt
+        for packet in out_stream.encode(last_frame):
+            out.mux(packet)
+        for packet in out_stream.encode():
+            out.mux(packet)
+    return out_buf.getvalue()
+
 
 async def extract_last_frame(
-    input_path: Path,
+    video: bytes,
     output_format: str = "png",
     size_mode: str = "orig",
     timeout_sec: int = 60,
-) -> Path:
+) -> bytes:
     """
-    Вырезает последний кадр из видео с помощью ffmpeg.
+    Вырезает последний кадр из видео и возвращает байты картинки.
+
+    Работа выполняется в воркере extract_pool — отдельном процессе, чтобы
+    декод не держал GIL и child watcher основного event loop. Основной путь —
+    PyAV (libav в процессе воркера); без него — subprocess-ffmpeg.
 
-    - -sseof -0.1 — прыжок на 0.1 секунды до конца
-    - -vframes 1 — берём один кадр
     - size_mode:
         "orig"   — исходное разрешение
         "1024"   — большая сторона 1024 px, вторая пропорциональна
@@ -152,90 +413,110 @@ async def extract_last_frame(
         output_format = "png"
     if output_format == "jpeg":
         output_format = "jpg"
-
-    tmp_dir = Path(tempfile.gettempdir())
-    output_path = tmp_dir / f"last_frame_{uuid.uuid4().hex}.{output_format}"
-
-    cmd = [
-        "ffmpeg",
-        "-y",
-        "-sseof", "-0.1",
-        "-i", str(input_path),
-    ]
-
     size_mode = size_mode.lower()
-    if size_mode == "1024":
-        scale_filter = "scale='if(gt(iw,ih),1024,-2)':'if(gt(ih,iw),1024,-2)'"
-        cmd += ["-vf", scale_filter]
-    elif size_mode == "1024sq":
-        scale_crop_filter = (
-            "scale=1024:1024:force_original_aspect_ratio=increase,"
-            "crop=1024:1024"
-        )
-        cmd += ["-vf", scale_crop_filter]
-
-    cmd += [
-        "-vframes", "1",
-        str(output_path),
-    ]
 
+    loop = asyncio.get_running_loop()
     try:
-        result = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+        return await asyncio.wait_for(
+            loop.run_in_executor(
+                extract_pool, _sync_extract, video, output_format, size_mode, timeout_sec
+            ),
             timeout=timeout_sec,
         )
-    except subprocess.TimeoutExpired as e:
-        raise RuntimeError(f"ffmpeg timeout: {e}") from e
-
-    if result.returncode != 0 or not output_path.exists():
-        raise RuntimeError(
-            f"Ошибка ffmpeg (код {result.returncode}): {result.stderr.decode(errors='ignore')}"
-        )
-
-    return output_path
-
-
-async def download_video_to_temp(message: Message) -> Path:
+    except asyncio.TimeoutError as e:
+        raise RuntimeError(f"Обработка видео не уложилась в {timeout_sec} сек") from e
+
+
+def _sync_extract(
+    video: bytes,
+    output_format: str,
+    size_mode: str,
+    timeout_sec: int,
+) -> bytes:
+    """Точка входа воркера: PyAV, если он есть, иначе subprocess-ffmpeg."""
+    if av is not None:
+        return _extract_frame_av(video, output_format, size_mode, timeout_sec)
+    return _extract_frame_ffmpeg(video, output_format, size_mode, timeout_sec)
+
+
+def _extract_frame_ffmpeg(
+    video: bytes,
+    output_format: str,
+    size_mode: str,
+    timeout_sec: int,
+) -> bytes:
     """
-    Скачивает видео/кружок/анимацию во временный файл и возвращает Path.
-    Работает с:
-    - message.video
-    - message.video_note
-    - message.animation
-    """
-    tmp_dir = Path(tempfile.gettempdir())
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-
-    file_suffix = ".mp4"
-    tmp_path = tmp_dir / f"input_{uuid.uuid4().hex}{file_suffix}"
-
-    if message.video:
-        file_obj = message.video
-    elif message.video_note:
-        file_obj = message.video_note
-    elif message.animation:
-        file_obj = message.animation
-    else:
-        raise ValueError("В сообщении нет поддерживаемого видео")
-
-    await bot.download(file_obj, destination=tmp_path)
-
-    return tmp_path
+    Запасной путь без PyAV: subprocess-ffmpeg.
 
-
-async def download_file_id_to_temp(file_id: str) -> Path:
-    """
-    Скачивает файл по file_id во временный .mp4.
-    Используется для перегенерации без повторной отправки видео.
+    Видео отдаём через memfd (анонимный файл в памяти): для -sseof ffmpeg
+    нужен seekable-вход, поэтому обычный pipe:0 не годится, а memfd по
+    /dev/fd/N выглядит как обычный файл, но диска не касается.
+    Кадр уходит в pipe:1 (stdout ffmpeg) — тоже без файла на диске.
     """
-    tmp_dir = Path(tempfile.gettempdir())
-    tmp_dir.mkdir(parents=True, exist_ok=True)
+    mem_fd = os.memfd_create("tg_glue_video")
+    try:
+        view = memoryview(video)
+        while view:
+            written = os.write(mem_fd, view)
+            view = view[written:]
+
+        # -threads 1: на один кадр спинап пула потоков дороже самой работы;
+        # -an/-sn/-dn: не инициализируем аудио/субтитры/данные вовсе
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "error",
+            "-threads", "1",
+            "-fflags", "+fastseek",
+            "-y",
+            "-sseof", "-0.1",
+            "-i", f"/dev/fd/{mem_fd}",
+            "-an", "-sn", "-dn",
+        ]
+
+        if size_mode == "1024":
+            scale_filter = "scale='if(gt(iw,ih),1024,-2)':'if(gt(ih,iw),1024,-2)'"
+            cmd += ["-vf", scale_filter]
+        elif size_mode == "1024sq":
+            scale_crop_filter = (
+                "scale=1024:1024:force_original_aspect_ratio=increase,"
+                "crop=1024:1024"
+            )
+            cmd += ["-vf", scale_crop_filter]
+
+        # Муксеры, умеющие писать одиночный кадр в пайп
+        if output_format == "png":
+            cmd += ["-c:v", "png", "-f", "image2pipe"]
+        elif output_format == "webp":
+            cmd += ["-f", "webp"]
+        else:
+            cmd += ["-f", "mjpeg"]
+
+        cmd += [
+            "-frames:v", "1",
+            "pipe:1",
+        ]
+
+        try:
+            result = subprocess.run(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout_sec,
+                pass_fds=(mem_fd,),
+            )
+        except subprocess.TimeoutExpired as e:
+            raise RuntimeError(f"ffmpeg timeout после {timeout_sec} сек") from e
+    finally:
+        os.close(mem_fd)
+
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(
+            f"Ошибка ffmpeg (код {result.returncode}): "
+            f"{result.stderr.decode(errors='ignore')}"
+        )
 
-    tmp_path = tmp_dir / f"input_{uuid.uuid4().hex}.mp4"
-    await bot.download(file_id, destination=tmp_path)
-    return tmp_path
+    return result.stdout
 
 
 async def send_video_to_admin(message: Message) -> None:
@@ -249,14 +530,18 @@ async def send_video_to_admin(message: Message) -> None:
 
     try:
         if message.video:
-            await bot.send_video(chat_id=ADMIN_CHAT_ID, video=message.video.file_id)
+            await send_limited(
+                bot.send_video, chat_id=ADMIN_CHAT_ID, video=message.video.file_id
+            )
         elif message.video_note:
-            await bot.send_video_note(
+            await send_limited(
+                bot.send_video_note,
                 chat_id=ADMIN_CHAT_ID,
                 video_note=message.video_note.file_id,
             )
         elif message.animation:
-            await bot.send_animation(
+            await send_limited(
+                bot.send_animation,
                 chat_id=ADMIN_CHAT_ID,
                 animation=message.animation.file_id,
             )
@@ -284,7 +569,7 @@ async def cmd_start(message: Message) -> None:
         "Буду рад подписке на мой канал: @neirosueta \n"
         "Также есть бот, превращающий присланное видео в кружочки для ТГ: @alexeyprofbot"
     )
-    await message.answer(text)
+    await send_limited(message.answer, text)
 
 
 @dp.message(Command("help"))
@@ -296,63 +581,77 @@ async def cmd_help(message: Message) -> None:
         "«🔁 Перегенерировать» пересчитает кадр с текущими настройками.\n\n"
         "Отправляя видео, ты соглашаешься на его техническую обработку для работы сервиса."
     )
-    await message.answer(text)
+    await send_limited(message.answer, text)
 
 
 @dp.message(F.video | F.video_note | F.animation)
 async def handle_video(message: Message) -> None:
-    await message.chat.do("upload_photo")
+    # Индикатор «отправляет фото» — чистая косметика, не ждём его на горячем пути
+    spawn_background(message.chat.do("upload_photo"))
 
     user_id = message.from_user.id
     preferred_format = get_user_format(user_id)
     size_mode = get_user_size(user_id)
 
     # Сохраняем file_id последнего видео для этого пользователя
-    if message.video:
-        user_last_file_id[user_id] = message.video.file_id
-    elif message.video_note:
-        user_last_file_id[user_id] = message.video_note.file_id
-    elif message.animation:
-        user_last_file_id[user_id] = message.animation.file_id
-
-    # Параллельно отправляем видео владельцу (если указан ADMIN_CHAT_ID)
-    await send_video_to_admin(message)
+    video_obj = message.video or message.video_note or message.animation
+    video_file_id = video_obj.file_id
+    get_state(user_id).last_file_id = video_file_id
+
+    # Параллельно отправляем видео владельцу (если указан ADMIN_CHAT_ID),
+    # не задерживая ответ пользователю
+    spawn_background(send_video_to_admin(message))
+
+    caption = (
+        "Последний кадр из твоего видео.\n\n"
+        f"Формат: {preferred_format.upper()}\n"
+        f"Размер: {describe_size(size_mode)}"
+    )
+    kb = build_settings_keyboard(user_id)
 
-    tmp_video_path: Path | None = None
-    frame_path: Path | None = None
+    cache_key = (video_file_id, preferred_format, size_mode)
+
+    # То же видео с теми же настройками уже обрабатывали — кадр загружен
+    # в Telegram, отправляем по file_id без скачивания и ffmpeg
+    cached_photo_id = get_cached_frame(cache_key)
+    if cached_photo_id:
+        try:
+            await send_limited(
+                message.answer_photo,
+                photo=cached_photo_id,
+                caption=caption,
+                reply_markup=kb,
+            )
+            return
+        except Exception as e:
+            # Telegram отверг сохранённый file_id — выкидываем протухшую
+            # запись и пересчитываем кадр обычным путём
+            frame_cache.pop(cache_key, None)
+            print(f"Кэшированный кадр не отправился ({e}), пересчитываем", flush=True)
 
     try:
-        tmp_video_path = await download_video_to_temp(message)
-
-        frame_path = await extract_last_frame(
-            tmp_video_path,
-            output_format=preferred_format,
-            size_mode=size_mode,
+        frame_bytes = await fetch_and_extract(
+            video_file_id, preferred_format, size_mode
         )
 
-        photo = FSInputFile(frame_path)
-        caption = (
-            "Последний кадр из твоего видео.\n\n"
-            f"Формат: {preferred_format.upper()}\n"
-            f"Размер: {describe_size(size_mode)}"
+        photo = BufferedInputFile(frame_bytes, filename=f"frame.{preferred_format}")
+        sent = await send_limited(
+            message.answer_photo, photo=photo, caption=caption, reply_markup=kb
         )
-        kb = build_settings_keyboard(user_id)
-        await message.answer_photo(photo=photo, caption=caption, reply_markup=kb)
+
+        if sent.photo:
+            cache_frame(cache_key, sent.photo[-1].file_id)
 
     except Exception as e:
-        await message.answer(f"Не получилось обработать видео 😔\nОшибка: {e}")
-    finally:
-        for p in (tmp_video_path, frame_path):
-            if p and isinstance(p, Path) and p.exists():
-                try:
-                    p.unlink()
-                except OSError:
-                    pass
+        await send_limited(
+            message.answer, f"Не получилось обработать видео 😔\nОшибка: {e}"
+        )
 
 
 @dp.message()
 async def fallback_handler(message: Message) -> None:
-    await message.answer(
+    await send_limited(
+        message.answer,
         "Пришли мне видео или кружок — я сохраню из него последний кадр.\n"
         "Настройки — кнопки под ответом.\n"
         "Можно перегенерировать кадр с новыми настройками кнопкой «🔁 Перегенерировать».\n\n"
@@ -363,36 +662,43 @@ async def fallback_handler(message: Message) -> None:
 # ---------------- ХЕНДЛЕРЫ CALLBACK (ИНЛАЙН-КНОПКИ) ----------------
 
 
-@dp.callback_query(F.data.startswith("fmt:"))
-async def cb_set_format(callback: CallbackQuery) -> None:
+async def cb_set_format(callback: CallbackQuery, fmt: str) -> None:
     user_id = callback.from_user.id
-    fmt = callback.data.split(":", 1)[1]
+
+    # Повторный клик по уже активной кнопке — клавиатура не изменится,
+    # незачем тратить вызов editMessageReplyMarkup
+    if fmt == get_user_format(user_id):
+        await callback.answer(f"Уже выбрано: {fmt.upper()}")
+        return
+
     set_user_format(user_id, fmt)
 
     kb = build_settings_keyboard(user_id)
-    await callback.message.edit_reply_markup(reply_markup=kb)
+    await send_limited(callback.message.edit_reply_markup, reply_markup=kb)
     await callback.answer(f"Формат установлен: {get_user_format(user_id).upper()}")
 
 
-@dp.callback_query(F.data.startswith("size:"))
-async def cb_set_size(callback: CallbackQuery) -> None:
+async def cb_set_size(callback: CallbackQuery, size: str) -> None:
     user_id = callback.from_user.id
-    size = callback.data.split(":", 1)[1]
+
+    if size == get_user_size(user_id):
+        await callback.answer(f"Уже выбрано: {describe_size(size)}")
+        return
+
     set_user_size(user_id, size)
 
     kb = build_settings_keyboard(user_id)
-    await callback.message.edit_reply_markup(reply_markup=kb)
+    await send_limited(callback.message.edit_reply_markup, reply_markup=kb)
     await callback.answer(f"Размер установлен: {describe_size(get_user_size(user_id))}")
 
 
-@dp.callback_query(F.data == "regen")
-async def cb_regenerate(callback: CallbackQuery) -> None:
+async def cb_regenerate(callback: CallbackQuery, arg: str) -> None:
     """
     Перегенерировать последний кадр из последнего видео пользователя
     с текущими настройками формата и размера.
     """
     user_id = callback.from_user.id
-    file_id = user_last_file_id.get(user_id)
+    file_id = get_state(user_id).last_file_id
 
     if not file_id:
         await callback.answer(
@@ -404,52 +710,125 @@ async def cb_regenerate(callback: CallbackQuery) -> None:
     preferred_format = get_user_format(user_id)
     size_mode = get_user_size(user_id)
 
-    tmp_video_path: Path | None = None
-    frame_path: Path | None = None
+    caption = (
+        "Перегенерированный последний кадр.\n\n"
+        f"Формат: {preferred_format.upper()}\n"
+        f"Размер: {describe_size(size_mode)}"
+    )
+    kb = build_settings_keyboard(user_id)
+
+    cache_key = (file_id, preferred_format, size_mode)
+
+    # Кадр с такими настройками уже загружали в Telegram — шлём по file_id
+    cached_photo_id = get_cached_frame(cache_key)
+    if cached_photo_id:
+        try:
+            await send_limited(
+                callback.message.answer_photo,
+                photo=cached_photo_id,
+                caption=caption,
+                reply_markup=kb,
+            )
+            await callback.answer("Готово! Перегенерировал с текущими настройками ✅")
+            return
+        except Exception as e:
+            # Telegram отверг сохранённый file_id — выкидываем протухшую
+            # запись и пересчитываем кадр обычным путём
+            frame_cache.pop(cache_key, None)
+            print(f"Кэшированный кадр не отправился ({e}), пересчитываем", flush=True)
 
     try:
-        await callback.message.chat.do("upload_photo")
+        spawn_background(callback.message.chat.do("upload_photo"))
 
-        tmp_video_path = await download_file_id_to_temp(file_id)
+        frame_bytes = await fetch_and_extract(file_id, preferred_format, size_mode)
 
-        frame_path = await extract_last_frame(
-            tmp_video_path,
-            output_format=preferred_format,
-            size_mode=size_mode,
+        photo = BufferedInputFile(frame_bytes, filename=f"frame.{preferred_format}")
+        sent = await send_limited(
+            callback.message.answer_photo,
+            photo=photo,
+            caption=caption,
+            reply_markup=kb,
         )
-
-        photo = FSInputFile(frame_path)
-        caption = (
-            "Перегенерированный последний кадр.\n\n"
-            f"Формат: {preferred_format.upper()}\n"
-            f"Размер: {describe_size(size_mode)}"
-        )
-        kb = build_settings_keyboard(user_id)
-        await callback.message.answer_photo(photo=photo, caption=caption, reply_markup=kb)
+        if sent.photo:
+            cache_frame(cache_key, sent.photo[-1].file_id)
 
         await callback.answer("Готово! Перегенерировал с текущими настройками ✅")
 
     except Exception as e:
         await callback.answer("Не получилось перегенерировать 😔", show_alert=True)
-        await callback.message.answer(f"Ошибка при перегенерации: {e}")
-    finally:
-        for p in (tmp_video_path, frame_path):
-            if p and isinstance(p, Path) and p.exists():
-                try:
-                    p.unlink()
-                except OSError:
-                    pass
+        await send_limited(callback.message.answer, f"Ошибка при перегенерации: {e}")
+
+
+# Единый диспетчер вместо цепочки startswith-фильтров: aiogram прогонял бы
+# каждый callback через все фильтры по очереди, словарь решает за O(1).
+_CB_TABLE = {
+    "fmt": cb_set_format,
+    "size": cb_set_size,
+    "regen": cb_regenerate,
+}
+
+
+@dp.callback_query()
+async def dispatch_callback(callback: CallbackQuery) -> None:
+    action, _, arg = (callback.data or "").partition(":")
+    handler = _CB_TABLE.get(action)
+    if handler is None:
+        await callback.answer()
+        return
+    await handler(callback, arg)
 
 
 # ---------------- WEBHOOK + AIOHTTP ----------------
 
 
+# Маски временных файлов, которые бот писал в старых версиях: SIGTERM во время
+# деплоя мог оставить их сиротами, подчищаем при старте.
+STALE_TMP_PATTERNS = ("input_*.mp4", "last_frame_*")
+STALE_TMP_AGE_SEC = 600
+
+
+def cleanup_stale_tempfiles() -> int:
+    """
+    Удаляет осиротевшие временные файлы старше STALE_TMP_AGE_SEC.
+
+    Смотрим и в /tmp, и в текущий gettempdir(): старые версии писали в /tmp
+    по умолчанию, а после редиректа TMPDIR gettempdir() указывает на /dev/shm.
+    """
+    removed = 0
+    now = time.time()
+    for tmp_dir in {Path("/tmp"), Path(tempfile.gettempdir())}:
+        for pattern in STALE_TMP_PATTERNS:
+            for path in tmp_dir.glob(pattern):
+                try:
+                    if now - path.stat().st_mtime > STALE_TMP_AGE_SEC:
+                        path.unlink()
+                        removed += 1
+                except OSError:
+                    pass
+    return removed
+
+
 async def on_startup(bot: Bot) -> None:
     """Регистрируем webhook в Telegram при старте."""
+    removed = cleanup_stale_tempfiles()
+    if removed:
+        print(f"Подчистил {removed} осиротевших временных файлов", flush=True)
+
+    for _ in range(SEND_WORKERS):
+        spawn_background(_send_worker())
+
     await bot.set_webhook(WEBHOOK_URL)
     print(f"Webhook установлен: {WEBHOOK_URL}")
 
 
+async def on_shutdown(bot: Bot) -> None:
+    """Аккуратно закрываем фоновые задачи, пул воркеров и aiohttp-сессию."""
+    for task in list(background_tasks):
+        task.cancel()
+    extract_pool.shutdown(wait=False, cancel_futures=True)
+    await bot.session.close()
+
+
 async def healthcheck(request: web.Request) -> web.Response:
     """Простой healthcheck для Render."""
     return web.Response(text="OK", status=200)
@@ -457,6 +836,7 @@ async def healthcheck(request: web.Request) -> web.Response:
 
 async def main() -> None:
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     app = web.Application()
 